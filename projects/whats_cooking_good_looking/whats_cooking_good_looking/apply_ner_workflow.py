@@ -1,12 +1,16 @@
 import json
+import tempfile
+from functools import lru_cache
 from pathlib import Path
 from typing import List
 
+import orjson
 import spacy
 from flytekit import Resources, task, workflow
 from snscrape.modules.twitter import TwitterSearchScraper
 
-from whats_cooking_good_looking.utils import (doc_to_spans, download_from_gcs,
+from whats_cooking_good_looking.utils import (doc_to_spans,
+                                              download_dir_from_gcs,
                                               load_config, upload_to_gcs)
 
 SPACY_MODEL = {"en": "en_core_web_sm"}
@@ -55,45 +59,72 @@ def get_tweets_list(
     return json.dumps(tweets_list)
 
 
+def load_spacy_model(model_uri: str) -> spacy.Language:
+    """Loads spacy model referenced by `model_uri`, either a spacy package name or the gcs URI of a tar.gz \
+        archive of a model saved with `nlp.to_disk()`.
+
+    Args:
+        model_uri (str): spacy package name or "gs://<bucket>/<blob>" URI.
+
+    Returns:
+        Language: spacy model.
+    """
+    if not model_uri.startswith("gs://"):
+        return spacy.load(model_uri)
+    gcs_bucket, gcs_source_blob_name = model_uri[len("gs://"):].split("/", 1)
+    model_dir = download_dir_from_gcs(gcs_bucket, gcs_source_blob_name, str(Path(tempfile.mkdtemp()) / "model"))
+    return spacy.load(model_dir)
+
+
+@lru_cache(maxsize=4)
+def load_inference_model(model_uri: str) -> spacy.Language:
+    """Loads spacy model with `load_spacy_model`, keeping it in memory so repeated inference loads within \
+        a worker skip download and disk I/O.
+    Only for read-only use: a cached model must not be trained in place, and `gs://` entries are never \
+        refreshed, so a long-lived process keeps the weights it first downloaded.
+
+    Args:
+        model_uri (str): spacy package name or "gs://<bucket>/<blob>" URI.
+
+    Returns:
+        Language: spacy model.
+    """
+    return load_spacy_model(model_uri)
+
+
 @task
 def load_model(
     lang: str,
     from_gcs: bool,
     gcs_bucket: str,
     gcs_source_blob_name: str,
-) -> spacy.Language:
-    """Loads spacy model either from gcs if specified or given the source language.
+) -> str:
+    """Resolves spacy model either from gcs if specified or given the source language. Only the model \
+        reference crosses task boundaries, tasks load it with `load_spacy_model` or `load_inference_model`.
 
     Args:
         lang (str): Language in which tweets must be written(iso-code).
         from_gcs (bool): True if needs to download custom spacy model from gcs.
         gcs_bucket (str): bucket name where to retrieve spacy model if from_gcs.
-        gcs_source_blob_name (str): blob name where to retrieve spacy model if from_gcs.
+        gcs_source_blob_name (str): blob name of the tar.gz spacy model archive (`nlp.to_disk()`) if from_gcs.
 
     Returns:
-        Language: spacy model.
+        str: model URI, gcs URI if from_gcs else spacy package name.
     """
     if from_gcs:
-        Path("tmp").mkdir(parents=True, exist_ok=True)
-        output_filename = download_from_gcs(
-            gcs_bucket, gcs_source_blob_name, "tmp", explicit_filepath=True
-        )[0]
-        nlp = spacy.load(output_filename)
-    else:
-        model_name = SPACY_MODEL[lang]
-        nlp = spacy.load(model_name)
-    return nlp
+        return f"gs://{gcs_bucket}/{gcs_source_blob_name}"
+    return SPACY_MODEL[lang]
 
 
 @task
 def apply_model(
-    nlp: bytes, tweets_list: str, bucket_name: str, source_blob_name: str
+    model_uri: str, tweets_list: str, bucket_name: str, source_blob_name: str
 ) -> str:
     """Applies spacy model to each tweet to extract entities from and convert them into
     Label studio task format.
 
     Args:
-        nlp (Language): Spacy model to use for inference.
+        model_uri (str): URI of spacy model to use for inference, as returned by `load_model`.
         tweets_list (str): json dumped list of tweets.
         bucket_name (str): Name of the GCS bucket to upload to.
         source_blob_name (str): File name of GCS uploaded file.
@@ -117,6 +148,7 @@ def apply_model(
                 }
             ]
     """
+    nlp = load_inference_model(model_uri)
     entities = set()
     labelstudio_tasks = []
     model_name = SPACY_MODEL["en"]
@@ -128,13 +160,13 @@ def apply_model(
         entities |= ents
         predictions.append({"model_version": model_name, "result": spans})
         labelstudio_tasks.append({"data": {"text": text}, "predictions": predictions})
-    with open("tasks.json", mode="w") as f:
-        json.dump(labelstudio_tasks, f, indent=2)
-    json_labelstudio_tasks = json.dumps(labelstudio_tasks)
+    with open("tasks.json", mode="wb") as f:
+        f.write(orjson.dumps(labelstudio_tasks, option=orjson.OPT_INDENT_2))
+    json_labelstudio_tasks = orjson.dumps(labelstudio_tasks)
     upload_to_gcs(
         bucket_name, source_blob_name, json_labelstudio_tasks, content_type=None
     )
-    return json_labelstudio_tasks
+    return json_labelstudio_tasks.decode()
 
 
 @workflow
@@ -166,14 +198,14 @@ def main() -> str:
         lang=config["lang"],
         max_results=config["max_results"],
     )
-    nlp = load_model(
+    model_uri = load_model(
         lang=config["lang"],
         from_gcs=config["from_gcs"],
         gcs_bucket=config["bucket_name"],
         gcs_source_blob_name=config["gcs_spacy_model_blob_name"],
     )
     return apply_model(
-        nlp=nlp,
+        model_uri=model_uri,
         tweets_list=tweets_list,
         bucket_name=config["bucket_name"],
         source_blob_name=config["applied_model_output_blob_name"],
@@ -1,33 +1,66 @@
-import json
-import pickle
+import logging
+import os
 import random
 from collections import defaultdict
+from pathlib import Path
+from typing import Annotated, List
 
+import ijson
+import orjson
 import spacy
-from flytekit import Resources, dynamic, task, workflow
+from flytekit import (HashMethod, Resources, current_context, dynamic, task,
+                      workflow)
+from flytekit.types.file import FlyteFile
 from spacy.language import Language
+from spacy.tokens import Doc
 from spacy.training import Example
-from spacy.util import compounding, minibatch
+from spacy.util import compounding, decaying, minibatch
 
-from whats_cooking_good_looking.apply_ner_workflow import load_model
-from whats_cooking_good_looking.utils import (download_bytes_from_gcs,
-                                              load_config, upload_to_gcs)
+from whats_cooking_good_looking.apply_ner_workflow import (load_model,
+                                                            load_spacy_model)
+from whats_cooking_good_looking.utils import (download_file_from_gcs,
+                                              hash_file, load_config,
+                                              load_train_data,
+                                              upload_dir_to_gcs)
 
 SPACY_MODEL = {"en": "en_core_web_sm"}
 
 CACHE_VERSION = "2.2"
+USE_GPU = os.getenv("SPACY_USE_GPU", "").lower() in {"1", "true", "yes"}
 request_resources = Resources(cpu="1", mem="500Mi", storage="500Mi")
 limit_resources = Resources(cpu="2", mem="1000Mi", storage="1000Mi")
+train_limit_resources = Resources(cpu="2", mem="4000Mi", storage="2000Mi", gpu="1" if USE_GPU else None)
+# GPU usage is decided at registration: forward the flag to the pod so training runs where the GPU is requested
+train_environment = {"SPACY_USE_GPU": "1"} if USE_GPU else {}
 
 THRESHOLD_ACCURACY = 0.7
+DROPOUT_START, DROPOUT_END = 0.35, 0.2
+SPACY_BATCH_SIZE = int(os.getenv("SPACY_BATCH_SIZE", "64"))
+
+logger = logging.getLogger(__file__)
+logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+
+def tokenize_texts(nlp: Language, texts: List[str]) -> List[Doc]:
+    """Tokenizes texts once with spacy model so docs can be reused across training iterations.
+
+    Args:
+        nlp (Language): Spacy model whose tokenizer is used.
+        texts (List[str]): Texts to tokenize.
+
+    Returns:
+        List[Doc]: Tokenized texts, without any pipeline component applied.
+    """
+    return list(nlp.pipe(texts, batch_size=SPACY_BATCH_SIZE, disable=nlp.pipe_names))
 
 
 @task
-def evaluate_ner(labelstudio_tasks: bytes) -> dict:
+def evaluate_ner(labelstudio_tasks: FlyteFile) -> dict:
     """Computes accuracy, precision and recall of NER model out of label studio output.
+    Tasks are streamed from the file one at a time.
 
     Args:
-        labelstudio_tasks (list): List of dicts outputs of label studio annotation with following format
+        labelstudio_tasks (FlyteFile): json file of label studio annotation outputs with following format
                         [
                             {
                             "result": [
@@ -54,118 +87,143 @@ def evaluate_ner(labelstudio_tasks: bytes) -> dict:
     """
     model_acc = dict()
     model_hits = defaultdict(int)
-    for ls_task in json.loads(labelstudio_tasks):
-        annotation_result = ls_task["result"][0]["value"]
-        for key in annotation_result:
+    num_task = 0
+    with open(labelstudio_tasks, "rb") as f:
+        for ls_task in ijson.items(f, "item"):
+            num_task += 1
+            annotation_result = ls_task["result"][0]["value"]
             annotation_result.pop("id", None)
-        for prediction in ls_task["predictions"]:
-            model_version = prediction["model_version"]
-            model_hits[model_version] += int(prediction["result"] == annotation_result)
+            for prediction in ls_task["predictions"]:
+                model_version = prediction["model_version"]
+                model_hits[model_version] += int(prediction["result"] == annotation_result)
 
-    num_task = len(labelstudio_tasks)
     for model_name, num_hits in model_hits.items():
         acc = num_hits / num_task
         model_acc[model_name] = acc
-        print(f"Accuracy for {model_name}: {acc:.2f}%")
+        logger.info(f"Accuracy for {model_name}: {acc:.2f}%")
     return model_acc
 
 
 @task
-def load_tasks(bucket_name: str, source_blob_name: str) -> bytes:
-    """Loads Label Studio annotations.
+def load_tasks(bucket_name: str, source_blob_name: str) -> Annotated[FlyteFile, HashMethod(hash_file)]:
+    """Loads Label Studio annotations. The file is hashed on its content so the cached
+    `train_model_if_necessary` is skipped when annotations did not change.
 
     Args:
         bucket_name (str): GCS bucket name where tasks are stored.
         source_blob_name (str): GCS blob name where tasks are stored.
 
     Returns:
-        str: json dumped tasks
+        FlyteFile: json file of tasks
     """
-    labelstudio_tasks = download_bytes_from_gcs(
-        bucket_name=bucket_name, source_blob_name=source_blob_name
+    labelstudio_tasks = download_file_from_gcs(
+        bucket_name=bucket_name,
+        source_blob_name=source_blob_name,
+        destination_file=str(Path(current_context().working_directory) / "labelstudio_tasks.json"),
     )
-    return labelstudio_tasks
+    return FlyteFile(path=labelstudio_tasks)
 
 
 @task
-def format_tasks_for_train(labelstudio_tasks: bytes) -> str:
+def format_tasks_for_train(labelstudio_tasks: FlyteFile) -> FlyteFile:
     """Format Label Studio output to be trained in spacy custom model.
+    Tasks are streamed one at a time and written as they are formatted.
 
     Args:
-        labelstudio_tasks (str): json dumped labelstudio_tasks
+        labelstudio_tasks (FlyteFile): json file of labelstudio_tasks
 
     Returns:
-        str: json dumped train data formatted
+        FlyteFile: jsonl train data file, one {"text": ..., "entities": [[start, end, label]]} per line
     """
-    train_data = []
-    for ls_task in json.loads(labelstudio_tasks):
-        entities = [
-            (ent["value"]["start"], ent["value"]["end"], label)
-            for ent in ls_task["result"]
-            for label in ent["value"]["labels"]
-        ]
-        if entities != []:
-            train_data.append((ls_task["task"]["data"]["text"], {"entities": entities}))
-    return json.dumps(train_data)
+    train_data_path = str(Path(current_context().working_directory) / "train_data.jsonl")
+    with open(labelstudio_tasks, "rb") as f_in, open(train_data_path, "wb") as f_out:
+        for ls_task in ijson.items(f_in, "item"):
+            entities = []
+            for ent in ls_task["result"]:
+                value = ent["value"]
+                start, end = value["start"], value["end"]
+                entities.extend((start, end, label) for label in value["labels"])
+            if entities:
+                f_out.write(orjson.dumps({"text": ls_task["task"]["data"]["text"], "entities": entities}))
+                f_out.write(b"\n")
+    return FlyteFile(path=train_data_path)
 
 
-@task
+@task(
+    requests=request_resources,
+    limits=train_limit_resources,
+    environment=train_environment,
+)
 def train_model(
-    train_data: str,
-    nlp: Language,
+    train_data: FlyteFile,
+    model_uri: str,
     training_iterations: int,
     bucket_out: str,
     source_blob_name: str,
-) -> Language:
+) -> str:
     """ Uses new labelled data to improve spacy NER model. Uploads trained model in GCS.
 
     Args:
-        train_data_files (List[str]): List of data filepath to train model on. After being loaded, format \
+        train_data (FlyteFile): jsonl data file to train model on. After being loaded, format \
             should be the following:
                 train_data = [
                     ("Text to detect Entities in.", {"entities": [(15, 23, "PRODUCT")]}),
                     ("Flyte is another example of organisation.", {"entities": [(0, 6, "ORG")]}),
                 ]
-        nlp (Language): Spacy base model to train on.
+        model_uri (str): URI of spacy base model to train on, as returned by `load_model`.
         training_iterations (int): Number of training iterations to make. Defaults to 30.
 
     Returns:
-        Language: Trained spacy model
+        str: gcs URI of trained spacy model
     """
-    train_data = json.loads(train_data)
+    if USE_GPU:
+        spacy.require_gpu()
+    train_data = load_train_data([train_data])
+    nlp = load_spacy_model(model_uri)
     ner = nlp.get_pipe("ner")
-    for _, annotations in train_data:
-        for ent in annotations.get("entities"):
-            ner.add_label(ent[2])
+    labels = {ent[2] for _, annotations in train_data for ent in annotations["entities"]}
+    for label in labels:
+        ner.add_label(label)
     pipe_exceptions = ["ner", "trf_wordpiecer", "trf_tok2vec"]
     unaffected_pipes = [pipe for pipe in nlp.pipe_names if pipe not in pipe_exceptions]
-    print("Starting model training")
+    texts = [text for text, _ in train_data]
+    annotations = [annotation for _, annotation in train_data]
+    docs = tokenize_texts(nlp, texts)
+    logger.info("Starting model training")
     with nlp.disable_pipes(*unaffected_pipes):
-        optimizer = spacy.blank("en").initialize()
+        optimizer = nlp.resume_training()
+        # Inverse-time decay (start / (1 + decay * t)) stepped once per iteration, reaching DROPOUT_END
+        # on the last iteration whatever the dataset size.
+        dropout_decay = (DROPOUT_START / DROPOUT_END - 1) / max(training_iterations - 1, 1)
+        dropout_schedule = decaying(DROPOUT_START, dropout_decay)
         for iteration in range(training_iterations):
-            random.shuffle(train_data)
+            dropout = max(DROPOUT_END, next(dropout_schedule))
+            examples = [
+                Example.from_dict(docs[idx], annotations[idx])
+                for idx in random.sample(range(len(docs)), len(docs))
+            ]
             losses = {}
-            batches = minibatch(train_data, size=compounding(4.0, 32.0, 1.001))
+            batch_size = compounding(32.0, 256.0, 1.001) if USE_GPU else compounding(4.0, 32.0, 1.001)
+            batches = minibatch(examples, size=batch_size)
             for batch in batches:
-                for text, annotations in batch:
-                    doc = nlp.make_doc(text)
-                    example = Example.from_dict(doc, annotations)
-                    nlp.update([example], drop=0.35, losses=losses, sgd=optimizer)
-                    print("Iteration n°", iteration)
-                    print("Losses", losses)
-    print("Model training completed !")
-    upload_to_gcs(bucket_out, source_blob_name, pickle.dumps(nlp))
-    print("Model upload on GCS completed !")
-    return nlp
+                nlp.update(batch, drop=dropout, losses=losses, sgd=optimizer)
+            logger.info(f"Iteration {iteration}, losses: {losses}")
+    logger.info("Model training completed !")
+    model_dir = str(Path(current_context().working_directory) / "model")
+    nlp.to_disk(model_dir)
+    upload_dir_to_gcs(bucket_out, source_blob_name, model_dir)
+    logger.info("Model upload on GCS completed !")
+    return f"gs://{bucket_out}/{source_blob_name}"
 
 
 @dynamic(
-    cache=False,
+    cache=True,
+    cache_version=CACHE_VERSION,
     requests=request_resources,
     limits=limit_resources,
 )
 def train_model_if_necessary(
-    labelstudio_tasks: bytes,
+    labelstudio_tasks: FlyteFile,
     metrics_dict: dict,
     model_name: str,
     training_iterations: int,
@@ -176,24 +234,24 @@ def train_model_if_necessary(
         and upload it to GCS.
 
     Args:
-        labelstudio_tasks (bytes): Label studio annotations
+        labelstudio_tasks (FlyteFile): Label studio annotations
         metrics_dict (dict): mapping between model name and accuracy
         model_name (str): model name from which we get accuracy
         training_iterations (int): number of training iterations for the spacy NER model
     """
     if metrics_dict[model_name] >= THRESHOLD_ACCURACY:
-        print(f"No need to train. Accuracy of {metrics_dict[model_name]} is above threshold {THRESHOLD_ACCURACY}")
+        logger.info(f"No need to train. Accuracy of {metrics_dict[model_name]} is above threshold {THRESHOLD_ACCURACY}")
     else:
         train_data = format_tasks_for_train(labelstudio_tasks=labelstudio_tasks)
-        nlp = load_model(
+        model_uri = load_model(
             lang="en",
             from_gcs=False,
             gcs_bucket=bucket_out,
             gcs_source_blob_name=model_output_blob_name,
         )
-        nlp = train_model(
+        train_model(
             train_data=train_data,
-            nlp=nlp,
+            model_uri=model_uri,
             training_iterations=training_iterations,
             bucket_out=bucket_out,
             source_blob_name=model_output_blob_name,
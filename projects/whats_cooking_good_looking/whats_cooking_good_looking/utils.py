@@ -1,5 +1,7 @@
+import hashlib
 import json
 import os
+import shutil
 from itertools import groupby
 from pathlib import Path
 from typing import List, Union
@@ -41,11 +43,12 @@ def doc_to_spans(doc):
     return results, entities
 
 
-def load_train_data(train_data_files: str) -> List:
+def load_train_data(train_data_files: List[str]) -> List:
     """Load jsonl train data as a list, ready to be ingested by spacy model.
+    Files are read line by line rather than loaded whole.
 
     Args:
-        train_data_local_path (str): Path of files to load.
+        train_data_files (List[str]): Paths of files to load.
 
     Returns:
         List: Tuple of texts and dict of entities to be used for training.
@@ -53,7 +56,7 @@ def load_train_data(train_data_files: str) -> List:
     train_data = []
     for data_file in train_data_files:
         with open(data_file, "r") as f:
-            for json_str in list(f):
+            for json_str in f:
                 train_data_dict = json.loads(json_str)
                 train_text = train_data_dict["text"]
                 train_entities = {
@@ -107,8 +110,73 @@ def download_bytes_from_gcs(bucket_name, source_blob_name):
     return blob.download_as_string()
 
 
+def hash_file(file_path: Union[str, os.PathLike]) -> str:
+    """Compute sha256 hex digest of a file content, reading it by chunks.
+
+    Args:
+        file_path (Union[str, os.PathLike]): Path of file to hash.
+
+    Returns:
+        str: Hex digest of file content.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def download_file_from_gcs(bucket_name: str, source_blob_name: str, destination_file: str) -> str:
+    """Download a single GCS blob to a local file.
+
+    Args:
+        bucket_name (str): Name of the GCS bucket.
+        source_blob_name (str): GCS path of the blob in the bucket.
+        destination_file (str): Local file path to download the blob to.
+
+    Returns:
+        str: Local file path
+    """
+    storage_client = storage.Client()
+    bucket = storage_client.bucket(bucket_name)
+    blob = bucket.blob(source_blob_name)
+    blob.download_to_filename(destination_file)
+    return destination_file
+
+
 def upload_to_gcs(bucket_name, source_blob_name, data, content_type=None):
     storage_client = storage.Client()
     bucket = storage_client.bucket(bucket_name)
     blob = bucket.blob(source_blob_name)
     blob.upload_from_string(data, content_type=content_type)
+
+
+def upload_dir_to_gcs(bucket_name: str, destination_blob_name: str, local_dir: str) -> None:
+    """Archive a local directory as tar.gz and upload it to GCS.
+
+    Args:
+        bucket_name (str): Name of the GCS bucket.
+        destination_blob_name (str): GCS path of the uploaded archive.
+        local_dir (str): Local directory to archive.
+    """
+    archive_path = shutil.make_archive(local_dir, "gztar", root_dir=local_dir)
+    storage_client = storage.Client()
+    bucket = storage_client.bucket(bucket_name)
+    blob = bucket.blob(destination_blob_name)
+    blob.upload_from_filename(archive_path)
+
+
+def download_dir_from_gcs(bucket_name: str, source_blob_name: str, destination_dir: str) -> str:
+    """Download a tar.gz archive uploaded with `upload_dir_to_gcs` and extract it locally.
+
+    Args:
+        bucket_name (str): Name of the GCS bucket.
+        source_blob_name (str): GCS path of the archive.
+        destination_dir (str): Local directory to extract the archive to.
+
+    Returns:
+        str: Local directory where the archive was extracted.
+    """
+    archive_path = download_file_from_gcs(bucket_name, source_blob_name, f"{destination_dir}.tar.gz")
+    shutil.unpack_archive(archive_path, destination_dir, "gztar")
+    return destination_dir